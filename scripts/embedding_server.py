@@ -2,44 +2,236 @@
 """
 Local embedding server for searchgrep using C2LLM-0.5B.
 Run with: python scripts/embedding_server.py
+
+Embeddings returned by /embeddings are L2-normalized, so cosine similarity
+is a plain dot product.
 """
 
 import argparse
-import json
+import base64
+import functools
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
 import sys
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 from typing import List
 
+import orjson
+
+logger = logging.getLogger("searchgrep.embedding_server")
+
 # Lazy load to show startup message first
 embedding_model = None
 reranker_model = None
 
+EMBEDDING_MODEL_NAME = "codefuse-ai/C2LLM-0.5B"
+
+# Texts per encode() forward pass; SEARCHGREP_BATCH_SIZE overrides the
+# device default chosen when the embedding model loads
+embedding_batch_size = 64
+
+# Backend, precision and device of the loaded embedding model, e.g.
+# "onnx-int8-cpu"; part of the disk-cache key since each variant's vectors differ
+embedding_model_variant = None
+
+# Distilled 2-layer cross-encoder, overridable with --reranker-model
+reranker_model_name = "cross-encoder/ms-marco-TinyBERT-L-2-v2"
+
+# Inference backend: "onnx" (INT8-quantized ONNX Runtime) or "torch"; "auto"
+# picks torch on CUDA machines and onnx otherwise
+backend = "onnx"
+
+# Load PyTorch weights in their checkpoint dtype, memory-mapped rather than
+# materialized twice
+TORCH_MODEL_KWARGS = {"torch_dtype": "auto", "low_cpu_mem_usage": True}
+
+# ONNX exports are cached here so the export only runs once
+ONNX_CACHE_DIR = Path.home() / ".cache" / "searchgrep_onnx"
+ONNX_QUANTIZED_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+# FP32 export saved alongside it, used on CUDA
+ONNX_FP32_FILE = "onnx/model.onnx"
+# Optimized graphs are suffixed with the quantized file's mtime so a re-export
+# invalidates them
+ONNX_OPTIMIZED_PREFIX = "model_qint8_avx512_vnni_optimized_"
+
+
+def synchronized(fn):
+    """Serialize calls to fn so concurrent requests load a model only once."""
+    lock = threading.Lock()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def env_batch_size():
+    """Parse SEARCHGREP_BATCH_SIZE, returning None when it is unset."""
+    value = os.environ.get("SEARCHGREP_BATCH_SIZE")
+    if value is None:
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise ValueError(
+            f"SEARCHGREP_BATCH_SIZE must be a positive integer, got {value!r}"
+        )
+    return size
+
+
+def cuda_available() -> bool:
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
 
+def onnx_cuda_available() -> bool:
+    """Whether the installed onnxruntime build has the CUDA execution provider."""
+    import onnxruntime as ort
+
+    return "CUDAExecutionProvider" in ort.get_available_providers()
+
+
+def compile_for_gpu(module):
+    """Cast a PyTorch module to FP16 on CUDA and compile it; a no-op on CPU.
+
+    CUDA graphs are left off: they are recorded per thread and per input shape,
+    while these models are called from batcher and handler threads with
+    arbitrary batch sizes and sequence lengths. Dynamic shapes keep one compiled
+    graph across those sizes instead of recompiling for each.
+    """
+    import torch
+
+    if not torch.cuda.is_available():
+        return module
+    module = module.to("cuda").half()
+    return torch.compile(module, mode="max-autotune-no-cudagraphs", dynamic=True)
+
+
+def load_onnx_model(model_cls, model_name: str, **kwargs):
+    """Load an ONNX export of a model, exporting it on first use.
+
+    On CPU this is the dynamically INT8-quantized export, with all ONNX Runtime
+    graph optimizations applied once and the optimized graph cached next to it.
+    When onnxruntime has the CUDA execution provider (installed with
+    sentence-transformers[onnx-gpu]), the FP32 export runs on it with IO binding,
+    so inputs and outputs are bound to device buffers instead of being copied
+    on every run.
+    """
+    import onnxruntime as ort
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model_dir = ONNX_CACHE_DIR / model_name.replace("/", "--")
+    if not (model_dir / ONNX_QUANTIZED_FILE).exists():
+        print(
+            f"Exporting {model_name} to quantized ONNX (first run only)...",
+            file=sys.stderr,
+        )
+        model = model_cls(model_name, backend="onnx", **kwargs)
+        model.save_pretrained(str(model_dir))
+        export_dynamic_quantized_onnx_model(model, "avx512_vnni", str(model_dir))
+
+    quantized_mtime = (model_dir / ONNX_QUANTIZED_FILE).stat().st_mtime_ns
+    optimized_file = f"onnx/{ONNX_OPTIMIZED_PREFIX}{quantized_mtime}.onnx"
+    for stale in (model_dir / "onnx").glob(f"{ONNX_OPTIMIZED_PREFIX}*.onnx"):
+        if stale != model_dir / optimized_file:
+            stale.unlink()
+
+    # ORT_ENABLE_ALL is ONNX Runtime's default; it is set explicitly because the
+    # cached optimized graph below is produced at this level
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = (
+        ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+
+    if onnx_cuda_available():
+        model_kwargs = {
+            "file_name": ONNX_FP32_FILE,
+            "provider": "CUDAExecutionProvider",
+            "use_io_binding": True,
+        }
+    elif (model_dir / optimized_file).exists():
+        # Already optimized offline; skip re-running the graph passes
+        session_options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        )
+        model_kwargs = {"file_name": optimized_file}
+    else:
+        session_options.optimized_model_filepath = str(model_dir / optimized_file)
+        model_kwargs = {"file_name": ONNX_QUANTIZED_FILE}
+    model_kwargs["session_options"] = session_options
+
+    return model_cls(
+        str(model_dir), backend="onnx", model_kwargs=model_kwargs, **kwargs
+    )
+
+
+@synchronized
 def load_embedding_model():
-    global embedding_model
+    global embedding_model, embedding_batch_size, embedding_model_variant
     if embedding_model is not None:
         return
 
+    batch_size = env_batch_size()
+
     print("Loading C2LLM-0.5B embedding model...", file=sys.stderr)
 
     try:
         from sentence_transformers import SentenceTransformer
 
-        embedding_model = SentenceTransformer(
-            "codefuse-ai/C2LLM-0.5B",
-            trust_remote_code=True,
-            tokenizer_kwargs={"padding_side": "left"},
+        load_kwargs = {
+            "trust_remote_code": True,
+            "tokenizer_kwargs": {"padding_side": "left"},
+            "prompts": {"code": CODE_INSTRUCTION, "query": QUERY_INSTRUCTION},
+        }
+        model = None
+        if backend == "onnx":
+            try:
+                model = load_onnx_model(
+                    SentenceTransformer, EMBEDDING_MODEL_NAME, **load_kwargs
+                )
+            except Exception as e:
+                print(f"ONNX export unavailable ({e}), using PyTorch", file=sys.stderr)
+        if model is not None:
+            variant = "onnx-fp32-cuda" if onnx_cuda_available() else "onnx-int8-cpu"
+        else:
+            model = SentenceTransformer(
+                EMBEDDING_MODEL_NAME, model_kwargs=TORCH_MODEL_KWARGS, **load_kwargs
+            )
+            model[0].auto_model = compile_for_gpu(model[0].auto_model)
+            param = next(model.parameters())
+            dtype = str(param.dtype).replace("torch.", "")
+            variant = f"torch-{dtype}-{param.device.type}"
+        embedding_batch_size = batch_size or (
+            128 if model.device.type == "cuda" else 64
         )
+        embedding_model_variant = variant
+        embedding_model = model
         print("Embedding model loaded successfully!", file=sys.stderr)
     except ImportError:
         print("Error: sentence-transformers not installed.", file=sys.stderr)
         print("Install with: pip install sentence-transformers", file=sys.stderr)
-        sys.exit(1)
+        raise
     except Exception as e:
         print(f"Error loading embedding model: {e}", file=sys.stderr)
-        sys.exit(1)
+        raise
 
 
+@synchronized
 def load_reranker_model():
     global reranker_model
     if reranker_model is not None:
@@ -50,19 +242,131 @@ def load_reranker_model():
     try:
         from sentence_transformers import CrossEncoder
 
-        # Use a lightweight but effective reranker
-        reranker_model = CrossEncoder(
-            "cross-encoder/ms-marco-MiniLM-L-6-v2", max_length=512
-        )
+        model = None
+        if backend == "onnx":
+            try:
+                model = load_onnx_model(
+                    CrossEncoder, reranker_model_name, max_length=512
+                )
+            except Exception as e:
+                print(f"ONNX export unavailable ({e}), using PyTorch", file=sys.stderr)
+        if model is None:
+            model = CrossEncoder(
+                reranker_model_name, max_length=512, model_kwargs=TORCH_MODEL_KWARGS
+            )
+            model.model = compile_for_gpu(model.model)
+        reranker_model = model
         print("Reranker model loaded successfully!", file=sys.stderr)
     except ImportError:
         print("Error: sentence-transformers not installed.", file=sys.stderr)
         print("Install with: pip install sentence-transformers", file=sys.stderr)
-        sys.exit(1)
+        raise
     except Exception as e:
         print(f"Error loading reranker model: {e}", file=sys.stderr)
-        sys.exit(1)
+        raise
+
+
+# Cross-encoder pairs scored per forward pass
+RERANK_BATCH_SIZE = 64
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts the least recently used entry when full."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def text_key(text: str) -> int:
+    """Stable 64-bit hash of a string."""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+# Scores keyed by (query hash, document hash)
+rerank_cache = LRUCache(100_000)
+
+# Embedding rows keyed by (is_query, text hash)
+embedding_cache = LRUCache(10_000)
+
+
+class EmbeddingStore:
+    """SQLite-backed map from content hash to float16 embedding bytes.
+
+    Holds at most max_entries rows; the oldest writes are evicted first.
+    """
+
+    # Stay under SQLite's bound-parameter limit
+    QUERY_CHUNK = 500
+
+    def __init__(self, path: Path, max_entries: int):
+        self.max_entries = max_entries
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Content hash of an instruction-prefixed text for the loaded model."""
+        content = f"{EMBEDDING_MODEL_NAME}/{embedding_model_variant}/normalized\n{text}"
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def get_many(self, keys: List[bytes]) -> dict:
+        import numpy as np
+
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self.QUERY_CHUNK):
+                chunk = keys[start : start + self.QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                )
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float16)
+        return found
+
+    def put_many(self, items: List[tuple]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, row.tobytes()) for key, row in items],
+            )
+
+            # Replaced rows get a new rowid, so the lowest rowids are the oldest
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN "
+                    "(SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
 
+# Opened in main() unless --no-disk-cache is given
+embedding_store = None
 
 # Task instruction for code retrieval
 CODE_INSTRUCTION = "Represent this code snippet for retrieval: "
@@ -72,6 +376,7 @@ QUERY_INSTRUCTION = "Represent this query for searching relevant code: "
 colbert_model = None
 
 
+@synchronized
 def load_colbert_model():
     global colbert_model
     if colbert_model is not None:
@@ -85,11 +390,15 @@ def load_colbert_model():
 
         # Use a smaller model that gives good token embeddings
         model_name = "microsoft/codebert-base"
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name, **TORCH_MODEL_KWARGS).to(device)
+        model.eval()
         colbert_model = {
-            "tokenizer": AutoTokenizer.from_pretrained(model_name),
-            "model": AutoModel.from_pretrained(model_name),
+            "tokenizer": tokenizer,
+            "model": compile_for_gpu(model),
+            "special_ids": torch.tensor(tokenizer.all_special_ids, device=device),
         }
-        colbert_model["model"].eval()
         print("ColBERT model loaded successfully!", file=sys.stderr)
     except Exception as e:
         print(f"Error loading ColBERT model: {e}", file=sys.stderr)
@@ -97,114 +406,255 @@ def load_colbert_model():
         colbert_model = None
 
 
-def get_token_embeddings(texts: List[str], max_length: int = 128) -> List[dict]:
-    """Get token-level embeddings for ColBERT-style matching."""
+def pool_tokens(embeddings, pool_factor: int = 2):
+    """Mean-pool clusters of similar token embeddings, keeping ~1/pool_factor of them.
+
+    Returns the pooled [n_clusters, dim] array and the token indices in each
+    cluster, with clusters ordered by their first token.
+    """
+    import numpy as np
+
+    if pool_factor <= 1 or len(embeddings) < 2:
+        return embeddings, [[i] for i in range(len(embeddings))]
+
+    from sklearn.cluster import AgglomerativeClustering
+
+    labels = AgglomerativeClustering(
+        n_clusters=max(1, len(embeddings) // pool_factor),
+        metric="cosine",
+        linkage="average",
+    ).fit_predict(embeddings)
+
+    _, first_index = np.unique(labels, return_index=True)
+    groups = [np.flatnonzero(labels == labels[i]) for i in np.sort(first_index)]
+    pooled = np.stack([embeddings[group].mean(axis=0) for group in groups])
+    return pooled, [group.tolist() for group in groups]
+
+
+def get_token_embeddings(
+    texts: List[str], max_length: int = 128, pool_factor: int = 2
+) -> List[dict]:
+    """Get token-level embeddings for ColBERT-style matching.
+
+    Similar tokens are pooled together to cut the vector count by pool_factor
+    (1 disables pooling); each pooled vector's token is its members joined by spaces.
+    max_length is clamped to the model's maximum sequence length.
+    """
     load_colbert_model()
 
     if colbert_model is None:
         # Fallback: use mean-pooled embedding per token window
-        return get_fallback_token_embeddings(texts, max_length)
+        return get_fallback_token_embeddings(texts, max_length, pool_factor)
 
     import torch
 
-    results = []
     tokenizer = colbert_model["tokenizer"]
     model = colbert_model["model"]
+    device = next(model.parameters()).device
+
+    # Tokenize and encode the whole batch in one forward pass
+    inputs = tokenizer(
+        texts,
+        return_tensors="pt",
+        max_length=min(max_length, tokenizer.model_max_length),
+        truncation=True,
+        padding=True,
+    ).to(device)
+
+    with torch.inference_mode(), torch.autocast(
+        "cuda", dtype=torch.float16, enabled=device.type == "cuda"
+    ):
+        outputs = model(**inputs)
+        hidden_states = outputs.last_hidden_state.float().cpu()  # [batch, seq, dim]
+
+    # Keep real tokens only: drop padding and special tokens
+    keep = (
+        inputs["attention_mask"].bool()
+        & ~torch.isin(inputs["input_ids"], colbert_model["special_ids"])
+    ).cpu()
+    input_ids = inputs["input_ids"].cpu()
 
-    with torch.no_grad():
-        for text in texts:
-            # Tokenize
-            inputs = tokenizer(
-                text,
-                return_tensors="pt",
-                max_length=max_length,
-                truncation=True,
-                padding=True,
-            )
-
-            # Get hidden states
-            outputs = model(**inputs)
-            token_embeddings = outputs.last_hidden_state[0]  # [seq_len, hidden_dim]
+    results = []
+    for token_embeddings, sample_ids, sample_keep in zip(
+        hidden_states, input_ids, keep
+    ):
+        tokens = tokenizer.convert_ids_to_tokens(sample_ids[sample_keep].tolist())
+        embeddings, groups = pool_tokens(
+            token_embeddings[sample_keep].numpy(), pool_factor
+        )
 
-            # Get tokens (for debugging/inspection)
-            tokens = tokenizer.convert_ids_to_tokens(inputs["input_ids"][0])
+        results.append(
+            {
+                "tokens": [" ".join(tokens[i] for i in group) for group in groups],
+                "embeddings": embeddings.astype("float16"),
+                "dimension": token_embeddings.shape[1],
+            }
+        )
 
-            # Filter out special tokens
-            attention_mask = inputs["attention_mask"][0]
-            valid_indices = [
-                i
-                for i, (mask, tok) in enumerate(zip(attention_mask, tokens))
-                if mask == 1 and tok not in ["[CLS]", "[SEP]", "[PAD]", "<s>", "</s>"]
-            ]
+    return results
 
-            filtered_embeddings = token_embeddings[valid_indices].tolist()
-            filtered_tokens = [tokens[i] for i in valid_indices]
 
-            results.append(
-                {
-                    "tokens": filtered_tokens,
-                    "embeddings": filtered_embeddings,
-                    "dimension": token_embeddings.shape[1],
-                }
-            )
+# Tokens shared by consecutive fallback windows (at most half a window)
+FALLBACK_WINDOW_STRIDE = 32
 
-    return results
+# Smallest max_length accepted by /colbert_embeddings
+MIN_MAX_LENGTH = 8
 
 
 def get_fallback_token_embeddings(
-    texts: List[str], max_length: int = 128
+    texts: List[str], max_length: int = 128, pool_factor: int = 2
 ) -> List[dict]:
-    """Fallback: split text into chunks and get embeddings for each."""
-    load_embedding_model()
+    """Fallback: embed overlapping token windows of each text.
 
-    results = []
-    chunk_size = 50  # characters per chunk
+    Windows are pooled by pool_factor the same way tokens are on the main path.
+    """
+    import torch
 
-    for text in texts:
-        chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
-        if not chunks:
-            chunks = [text]
+    load_embedding_model()
 
-        # Get embeddings for each chunk
-        embeddings = embedding_model.encode(chunks, convert_to_numpy=True)
+    tokenizer = embedding_model.tokenizer
+    # Longer windows would be truncated by encode() and lose their tail
+    max_length = min(max_length, embedding_model.max_seq_length or max_length)
+    window = max(1, max_length - 2)
+    # Cap the overlap at half a window so small max_length values cannot
+    # degenerate into one window per token
+    step = window - min(FALLBACK_WINDOW_STRIDE, window // 2)
+
+    # Slide a window over each text's token ids so chunks never split a token
+    text_chunks = []
+    for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]:
+        starts = range(0, max(len(ids) - window, 0) + step, step)
+        text_chunks.append([tokenizer.decode(ids[i : i + window]) for i in starts])
+
+    # Embed every window of every text in one call
+    with torch.inference_mode():
+        embeddings = embedding_model.encode(
+            [chunk for chunks in text_chunks for chunk in chunks],
+            batch_size=embedding_batch_size,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+            convert_to_numpy=True,
+        )
 
+    results = []
+    offset = 0
+    for chunks in text_chunks:
+        pooled, groups = pool_tokens(
+            embeddings[offset : offset + len(chunks)], pool_factor
+        )
         results.append(
             {
-                "tokens": chunks,
-                "embeddings": embeddings.tolist(),
-                "dimension": embeddings.shape[1]
-                if len(embeddings.shape) > 1
-                else len(embeddings),
+                "tokens": [" ".join(chunks[i] for i in group) for group in groups],
+                "embeddings": pooled,
+                "dimension": embeddings.shape[1],
             }
         )
+        offset += len(chunks)
 
     return results
 
 
-def get_embeddings(texts: List[str], is_query: bool = False) -> List[List[float]]:
-    """Get embeddings for a list of texts."""
+def get_embeddings(texts: List[str], is_query: bool = False):
+    """Get float16 embeddings for a list of texts as a [len(texts), dim] array."""
+    import numpy as np
+    import torch
+
     load_embedding_model()
 
-    instruction = QUERY_INSTRUCTION if is_query else CODE_INSTRUCTION
-    prefixed_texts = [instruction + text for text in texts]
+    prompt_name = "query" if is_query else "code"
+    instruction = embedding_model.prompts[prompt_name]
+
+    # Only encode texts that missed the cache
+    keys = [(is_query, text_key(text)) for text in texts]
+    rows = [embedding_cache.get(key) for key in keys]
+    misses = [i for i, row in enumerate(rows) if row is None]
+
+    # Then fall back to the on-disk store
+    store_keys = {}
+    if misses and embedding_store is not None:
+        store_keys = {i: EmbeddingStore.key(instruction + texts[i]) for i in misses}
+        stored = embedding_store.get_many(list(store_keys.values()))
+        for i in misses:
+            row = stored.get(store_keys[i])
+            if row is not None:
+                rows[i] = row
+                embedding_cache.put(keys[i], row)
+        misses = [i for i in misses if rows[i] is None]
+
+    if misses:
+        # Encode each distinct text once; duplicates share its row
+        first_index = {}
+        for i in misses:
+            first_index.setdefault(texts[i], i)
+        logger.debug(
+            "Embedding %d unique of %d uncached texts", len(first_index), len(misses)
+        )
 
-    embeddings = embedding_model.encode(prefixed_texts, convert_to_numpy=True)
-    return embeddings.tolist()
+        with torch.inference_mode():
+            embeddings = embedding_model.encode(
+                list(first_index),
+                prompt_name=prompt_name,
+                batch_size=embedding_batch_size,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            ).astype(np.float16)
+        encoded = dict(zip(first_index, embeddings))
+        for i in misses:
+            rows[i] = encoded[texts[i]]
+            embedding_cache.put(keys[i], rows[i])
+        if embedding_store is not None:
+            embedding_store.put_many(
+                [(store_keys[i], encoded[text]) for text, i in first_index.items()]
+            )
+
+    return np.stack(rows)
 
 
-def rerank(query: str, documents: List[str], top_k: int = None) -> List[dict]:
-    """Rerank documents using cross-encoder."""
+def score_pairs(pairs: List[tuple]) -> List[float]:
+    """Score (query, document) pairs with the cross-encoder."""
+    import torch
+
     load_reranker_model()
 
-    if not documents:
-        return []
+    # Reuse scores for pairs seen in earlier requests
+    keys = [(text_key(query), text_key(doc)) for query, doc in pairs]
+    scores = [rerank_cache.get(key) for key in keys]
+    misses = [i for i, score in enumerate(scores) if score is None]
+
+    if misses:
+        # Score each distinct pair once; duplicate documents share its score
+        unique = list(dict.fromkeys(tuple(pairs[i]) for i in misses))
+        logger.debug("Scoring %d unique of %d uncached pairs", len(unique), len(misses))
+
+        # Score pairs shortest-first so each batch only pads to similar lengths
+        lengths = [
+            len(ids)
+            for ids in reranker_model.tokenizer(
+                [query for query, _ in unique],
+                [doc for _, doc in unique],
+                truncation=True,
+                max_length=512,
+            )["input_ids"]
+        ]
+        order = sorted(range(len(unique)), key=lengths.__getitem__)
+        with torch.inference_mode():
+            sorted_scores = reranker_model.predict(
+                [list(unique[j]) for j in order], batch_size=RERANK_BATCH_SIZE
+            )
+
+        scored = {unique[j]: float(score) for j, score in zip(order, sorted_scores)}
+        for i in misses:
+            scores[i] = scored[tuple(pairs[i])]
+            rerank_cache.put(keys[i], scores[i])
 
-    # Create query-document pairs
-    pairs = [[query, doc] for doc in documents]
+    return scores
 
-    # Get scores from cross-encoder
-    scores = reranker_model.predict(pairs)
 
+def rank_documents(
+    documents: List[str], scores: List[float], top_k: int = None
+) -> List[dict]:
+    """Order documents by score, keeping their original indices."""
     # Create results with scores
     results = [
         {"index": i, "score": float(score), "document": doc}
@@ -221,50 +671,233 @@ def rerank(query: str, documents: List[str], top_k: int = None) -> List[dict]:
     return results
 
 
+# Dynamic batching: wait up to MAX_WAIT_MS for up to MAX_BATCH concurrent requests
+MAX_BATCH = 32
+MAX_WAIT_MS = 5
+
+
+class MicroBatcher:
+    """Coalesces concurrent requests into one call of process() on a worker thread.
+
+    process() receives a list of request items and returns one result per item.
+    """
+
+    def __init__(
+        self, process, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS
+    ):
+        self._process = process
+        self._max_batch = max_batch
+        self._max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item):
+        """Queue an item and block until its result is ready."""
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._resolve(batch)
+
+    def _resolve(self, batch: List[tuple]):
+        try:
+            results = self._process([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                # Retry one at a time so a bad request only fails its own caller
+                for entry in batch:
+                    self._resolve([entry])
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+def embed_batch(requests: List[tuple]) -> list:
+    """Embed several (texts, is_query) requests with one model call per kind."""
+    results = [None] * len(requests)
+    for is_query in (False, True):
+        group = [i for i, (_, q) in enumerate(requests) if q == is_query]
+        if not group:
+            continue
+
+        embeddings = get_embeddings(
+            [text for i in group for text in requests[i][0]], is_query
+        )
+        offset = 0
+        for i in group:
+            count = len(requests[i][0])
+            results[i] = embeddings[offset : offset + count]
+            offset += count
+
+    return results
+
+
+def rerank_batch(requests: List[tuple]) -> List[List[dict]]:
+    """Rerank several (query, documents, top_k) requests with one scoring pass."""
+    scores = score_pairs(
+        [(query, doc) for query, documents, _ in requests for doc in documents]
+    )
+
+    results = []
+    offset = 0
+    for _, documents, top_k in requests:
+        count = len(documents)
+        results.append(
+            rank_documents(documents, scores[offset : offset + count], top_k)
+        )
+        offset += count
+
+    return results
+
+
+def warmup_models():
+    """Run one dummy forward through each loaded model before serving.
+
+    This pays the initial torch.compile cost at startup rather than on the
+    first request.
+    """
+    import torch
+
+    with torch.inference_mode():
+        if embedding_model is not None:
+            embedding_model.encode(["warmup"])
+        if reranker_model is not None:
+            reranker_model.predict([["warmup", "warmup"]])
+    if colbert_model is not None:
+        get_token_embeddings(["warmup"])
+
+
+# Started in main()
+embedding_batcher = None
+rerank_batcher = None
+
+
+# Response encodings for embedding arrays, selected with "encoding_format"
+ENCODING_FORMATS = ("float", "base64")
+
+
+def encode_array(array, encoding_format: str = "float"):
+    """Serialize an embedding array as nested float lists or base64 float16 bytes."""
+    import numpy as np
+
+    if encoding_format == "base64":
+        return {
+            "shape": list(array.shape),
+            "dtype": "float16",
+            "data": base64.b64encode(array.astype(np.float16).tobytes()).decode(),
+        }
+    # orjson serializes float32 arrays directly but has no float16 support
+    return array.astype(np.float32)
+
+
+# /colbert_embeddings can also return token vectors projected to
+# COLBERT_INT8_DIM dimensions and quantized to int8
+COLBERT_ENCODING_FORMATS = ENCODING_FORMATS + ("int8",)
+COLBERT_INT8_DIM = 128
+
+
+@functools.lru_cache(maxsize=None)
+def projection_matrix(dim: int):
+    """Fixed random projection from dim to COLBERT_INT8_DIM dimensions.
+
+    Seeded so queries and documents are projected identically across restarts.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((dim, COLBERT_INT8_DIM), dtype=np.float32)
+    return (matrix / np.sqrt(COLBERT_INT8_DIM)).astype(np.float32)
+
+
+def quantize_int8(embeddings) -> dict:
+    """Project token embeddings and quantize each vector to int8 with its own scale."""
+    import numpy as np
+
+    projected = embeddings.astype(np.float32) @ projection_matrix(embeddings.shape[1])
+    scales = np.abs(projected).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    quantized = np.round(projected / scales[:, None]).astype(np.int8)
+    return {
+        "shape": list(quantized.shape),
+        "dtype": "int8",
+        "data": base64.b64encode(quantized.tobytes()).decode(),
+        "scales": scales.astype(np.float32),
+    }
+
+
 class EmbeddingHandler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests from the same client
+    protocol_version = "HTTP/1.1"
+    # Close idle kept-alive connections so they do not pin handler threads
+    timeout = 60
+
     def log_message(self, format, *args):
         # Suppress default logging
         pass
 
     def send_json_response(self, data: dict, status: int = 200):
+        payload = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(payload)
 
     def do_POST(self):
-        if self.path == "/embeddings":
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
+        # Always consume the body so it is not read as the next request on a
+        # kept-alive connection
+        content_length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(content_length)
 
+        if self.path == "/embeddings":
             try:
-                data = json.loads(body)
+                data = orjson.loads(body)
                 texts = data.get("texts", [])
                 is_query = data.get("is_query", False)
+                encoding_format = data.get("encoding_format", "float")
 
                 if not texts:
                     self.send_json_response({"error": "No texts provided"}, 400)
                     return
 
-                embeddings = get_embeddings(texts, is_query)
+                if encoding_format not in ENCODING_FORMATS:
+                    self.send_json_response({"error": "Invalid encoding_format"}, 400)
+                    return
+
+                # Load outside the batcher so a failed load fails only this request
+                load_embedding_model()
+                embeddings = embedding_batcher.submit((texts, bool(is_query)))
                 self.send_json_response(
                     {
-                        "embeddings": embeddings,
-                        "model": "codefuse-ai/C2LLM-0.5B",
-                        "dimension": len(embeddings[0]) if embeddings else 0,
+                        "embeddings": encode_array(embeddings, encoding_format),
+                        "model": EMBEDDING_MODEL_NAME,
+                        "dimension": embeddings.shape[1],
+                        "normalized": True,
                     }
                 )
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 self.send_json_response({"error": "Invalid JSON"}, 400)
             except Exception as e:
                 self.send_json_response({"error": str(e)}, 500)
 
         elif self.path == "/rerank":
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
-
             try:
-                data = json.loads(body)
+                data = orjson.loads(body)
                 query = data.get("query", "")
                 documents = data.get("documents", [])
                 top_k = data.get("top_k")
@@ -277,39 +910,69 @@ class EmbeddingHandler(BaseHTTPRequestHandler):
                     self.send_json_response({"error": "No documents provided"}, 400)
                     return
 
-                results = rerank(query, documents, top_k)
+                load_reranker_model()
+                results = rerank_batcher.submit((query, documents, top_k))
                 self.send_json_response(
                     {
                         "results": results,
-                        "model": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                        "model": reranker_model_name,
                     }
                 )
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 self.send_json_response({"error": "Invalid JSON"}, 400)
             except Exception as e:
                 self.send_json_response({"error": str(e)}, 500)
 
         elif self.path == "/colbert_embeddings":
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
-
             try:
-                data = json.loads(body)
+                data = orjson.loads(body)
                 texts = data.get("texts", [])
                 max_length = data.get("max_length", 128)
+                pool_factor = data.get("pool_factor", 2)
+                encoding_format = data.get("encoding_format", "float")
 
                 if not texts:
                     self.send_json_response({"error": "No texts provided"}, 400)
                     return
 
-                results = get_token_embeddings(texts, max_length)
+                if encoding_format not in COLBERT_ENCODING_FORMATS:
+                    self.send_json_response({"error": "Invalid encoding_format"}, 400)
+                    return
+
+                if (
+                    not isinstance(pool_factor, int)
+                    or isinstance(pool_factor, bool)
+                    or pool_factor < 1
+                ):
+                    self.send_json_response({"error": "Invalid pool_factor"}, 400)
+                    return
+
+                if (
+                    not isinstance(max_length, int)
+                    or isinstance(max_length, bool)
+                    or max_length < MIN_MAX_LENGTH
+                ):
+                    self.send_json_response(
+                        {"error": f"max_length must be at least {MIN_MAX_LENGTH}"}, 400
+                    )
+                    return
+
+                results = get_token_embeddings(texts, max_length, pool_factor)
+                for result in results:
+                    if encoding_format == "int8":
+                        result["embeddings"] = quantize_int8(result["embeddings"])
+                        result["dimension"] = COLBERT_INT8_DIM
+                    else:
+                        result["embeddings"] = encode_array(
+                            result["embeddings"], encoding_format
+                        )
                 self.send_json_response(
                     {
                         "results": results,
                         "model": "microsoft/codebert-base",
                     }
                 )
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 self.send_json_response({"error": "Invalid JSON"}, 400)
             except Exception as e:
                 self.send_json_response({"error": str(e)}, 500)
@@ -318,8 +981,8 @@ class EmbeddingHandler(BaseHTTPRequestHandler):
             self.send_json_response(
                 {
                     "status": "ok",
-                    "embedding_model": "codefuse-ai/C2LLM-0.5B",
-                    "reranker_model": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                    "embedding_model": EMBEDDING_MODEL_NAME,
+                    "reranker_model": reranker_model_name,
                     "colbert_model": "microsoft/codebert-base",
                 }
             )
@@ -332,9 +995,9 @@ class EmbeddingHandler(BaseHTTPRequestHandler):
             self.send_json_response(
                 {
                     "status": "ok",
-                    "embedding_model": "codefuse-ai/C2LLM-0.5B",
+                    "embedding_model": EMBEDDING_MODEL_NAME,
                     "embedding_ready": embedding_model is not None,
-                    "reranker_model": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+                    "reranker_model": reranker_model_name,
                     "reranker_ready": reranker_model is not None,
                     "colbert_model": "microsoft/codebert-base",
                     "colbert_ready": colbert_model is not None,
@@ -345,19 +1008,94 @@ class EmbeddingHandler(BaseHTTPRequestHandler):
 
 
 def main():
+    global backend, reranker_model_name, embedding_store
+    global embedding_batcher, rerank_batcher
+
     parser = argparse.ArgumentParser(
         description="Local embedding server for searchgrep"
     )
     parser.add_argument("--port", type=int, default=11434, help="Port to run server on")
     parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind to")
     parser.add_argument("--preload", action="store_true", help="Load models on startup")
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "onnx", "torch"],
+        default="auto",
+        help="Inference backend (onnx = INT8-quantized ONNX Runtime, "
+        "auto = torch on CUDA, onnx otherwise)",
+    )
+    parser.add_argument(
+        "--reranker-model",
+        type=str,
+        default=reranker_model_name,
+        help="Cross-encoder model used by /rerank",
+    )
+    parser.add_argument(
+        "--cache-path",
+        type=Path,
+        default=Path.home() / ".cache" / "searchgrep" / "embeddings.sqlite3",
+        help="SQLite file used to persist embeddings across restarts",
+    )
+    parser.add_argument(
+        "--no-disk-cache",
+        action="store_true",
+        help="Do not persist embeddings to disk",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=500_000,
+        help="Embeddings kept on disk before the oldest are evicted",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="WARNING",
+        help="Logging verbosity (DEBUG reports per-batch deduplication)",
+    )
     args = parser.parse_args()
 
+    # Configure only this module's logger so DEBUG does not enable library logs
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(args.log_level)
+    logger.propagate = False
+
+    try:
+        env_batch_size()
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cache_max_entries < 1:
+        parser.error("--cache-max-entries must be a positive integer")
+
+    backend = args.backend
+    if backend == "auto":
+        backend = "torch" if cuda_available() else "onnx"
+    reranker_model_name = args.reranker_model
+    if not args.no_disk_cache:
+        embedding_store = EmbeddingStore(args.cache_path, args.cache_max_entries)
+
     if args.preload:
-        load_embedding_model()
-        load_reranker_model()
+        # Load models concurrently so startup takes the slowest load, not the sum
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(load_embedding_model),
+                executor.submit(load_reranker_model),
+                executor.submit(load_colbert_model),
+            ]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                # The loader has already reported the error
+                sys.exit(1)
+        warmup_models()
+
+    embedding_batcher = MicroBatcher(embed_batch)
+    rerank_batcher = MicroBatcher(rerank_batch)
 
-    server = HTTPServer((args.host, args.port), EmbeddingHandler)
+    server = ThreadingHTTPServer((args.host, args.port), EmbeddingHandler)
     print(
         f"Embedding server running at http://{args.host}:{args.port}", file=sys.stderr
     )